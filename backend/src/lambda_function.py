@@ -4,150 +4,275 @@ Processes image editing requests using Amazon Titan Image Generator v2
 """
 
 import boto3
-import json
-import base64
+import botocore.config
+import orjson
+import pybase64
+import binascii
 import time
 import uuid
 import os
-from io import BytesIO
-from random import randint
-from datetime import datetime
+import sys
+import types
 
 from utils import (
     get_cors_headers,
-    calculate_base64_size,
     calculate_output_images_size,
     log_to_dynamodb
 )
 from titan_handler import prepare_titan_request
 
+# Created once per execution environment so warm invocations reuse the
+# client and its HTTPS connection pool
+_BEDROCK = boto3.client(
+    'bedrock-runtime',
+    config=botocore.config.Config(
+        tcp_keepalive=True,
+        retries={'mode': 'standard', 'max_attempts': 2}
+    )
+)
+# Parse the InvokeModel operation model from botocore's data files during
+# INIT rather than on the first request
+_BEDROCK.meta.service_model.operation_model('InvokeModel')
+# CORS headers are static per deployment; the read-only view guards the shared
+# copy, and each response gets its own plain dict for the runtime's JSON encoder
+_CORS_HEADERS = types.MappingProxyType(dict(get_cors_headers()))
+_DEBUG = bool(os.environ.get('DEBUG'))
 
-def lambda_handler(event, context):
+_SUPPORTED_MODELS = frozenset({'titan'})
+_MODEL_ID = 'amazon.titan-image-generator-v2:0'
+_CT = 'application/json'
+# Request bodies larger than this are rejected before they are parsed. Lambda
+# itself rejects synchronous payloads over 6 MB, so the limit must sit below that
+_MAX_BODY = int(os.environ.get('MAX_BODY_BYTES', 5 * 1024 * 1024))
+
+# Placeholder fields returned alongside an error response by _extract_fields
+_NO_FIELDS = (None,) * 6
+
+
+def _strip_data_uri(s):
     """
-    Main Lambda handler for image editing requests
+    Strip a "data:<mime>;base64," prefix from a base64 string, if present
     
     Args:
-        event: API Gateway event with request body
-        context: Lambda context object
+        s: Base64 string, optionally prefixed with a data URI header
         
     Returns:
-        dict: Response with status code, headers, and body
+        str: The bare base64 payload
     """
-    # Generate unique request ID for tracking
-    request_id = str(uuid.uuid4())
-    start_time = time.time()
+    head, sep, tail = s.partition(',')
+    return tail if sep else head
+
+
+def _err(code, msg, **extra):
+    """
+    Build an error response with the shared CORS headers
     
-    # Debug: Log the incoming event
-    print(f"Received event: {json.dumps(event)}")
+    Args:
+        code: HTTP status code
+        msg: Error message returned under the "error" key
+        **extra: Additional fields to include in the response body
+        
+    Returns:
+        dict: Response with status code, headers, and body
+    """
+    payload = {'error': msg, **extra}
+    return {'statusCode': code, 'headers': dict(_CORS_HEADERS), 'body': orjson.dumps(payload).decode()}
+
+
+def _parse_body(event, trace):
+    """
+    Parse the request body from an API Gateway or direct invocation event
     
-    # Extract the request body
+    Args:
+        event: Lambda event
+        trace: Per-request log record, updated in place
+        
+    Returns:
+        tuple: (body, error_response) - exactly one of the two is None
+    """
     try:
         # Check if body exists
         if 'body' not in event:
-            print("ERROR: 'body' key not found in event")
-            return {
-                'statusCode': 400,
-                'headers': get_cors_headers(),
-                'body': json.dumps({'error': 'Missing body in request', 'event_keys': list(event.keys())})
-            }
+            trace['error'] = "'body' key not found in event"
+            return None, _err(400, 'Missing body in request', event_keys=list(event.keys()))
         
         # Check if body is already a dict (direct Lambda invocation) or string (API Gateway)
-        if isinstance(event['body'], dict):
-            body = event['body']
-        elif isinstance(event['body'], str):
-            body = json.loads(event['body'])
-        else:
-            print(f"ERROR: Unexpected body type: {type(event['body'])}")
-            return {
-                'statusCode': 400,
-                'headers': get_cors_headers(),
-                'body': json.dumps({'error': f'Invalid body type: {type(event["body"])}'})
-            }
-            
-    except json.JSONDecodeError as e:
-        print(f"ERROR: JSON decode error: {str(e)}")
-        print(f"Body content: {event.get('body', 'NO BODY')[:200]}")
-        return {
-            'statusCode': 400,
-            'headers': get_cors_headers(),
-            'body': json.dumps({'error': f'Invalid JSON in request body: {str(e)}'})
-        }
+        raw = event['body']
+        if isinstance(raw, dict):
+            # Direct invocations are already parsed; bound them by the image
+            # strings, which make up nearly all of the payload
+            image_chars = sum(len(raw[k]) for k in ('mask', 'base_image') if isinstance(raw.get(k), str))
+            if image_chars > _MAX_BODY:
+                trace['error'] = 'Request body exceeds MAX_BODY_BYTES'
+                return None, _err(413, 'Payload too large', max_bytes=_MAX_BODY)
+            return raw, None
+        if isinstance(raw, str):
+            # Checked in characters rather than bytes to avoid encoding the body;
+            # the base64 images that dominate it are one byte per character
+            if len(raw) > _MAX_BODY:
+                trace['error'] = 'Request body exceeds MAX_BODY_BYTES'
+                return None, _err(413, 'Payload too large', max_bytes=_MAX_BODY)
+            return orjson.loads(raw), None
+        trace['error'] = f'Unexpected body type: {type(raw)}'
+        return None, _err(400, f'Invalid body type: {type(raw)}')
+    except orjson.JSONDecodeError as e:
+        trace['error'] = f'JSON decode error: {str(e)}'
+        if _DEBUG:
+            trace['body_preview'] = event.get('body', 'NO BODY')[:200]
+        return None, _err(400, f'Invalid JSON in request body: {str(e)}')
     except Exception as e:
-        print(f"ERROR: Unexpected error parsing body: {str(e)}")
-        return {
-            'statusCode': 400,
-            'headers': get_cors_headers(),
-            'body': json.dumps({'error': f'Error parsing request body: {str(e)}'})
-        }
+        trace['error'] = f'Unexpected error parsing body: {str(e)}'
+        return None, _err(400, f'Error parsing request body: {str(e)}')
+
+
+def _extract_fields(body, trace, owned):
+    """
+    Validate the request body and the base64 input images
     
-    # Get the required parameters
+    Args:
+        body: Parsed request body
+        trace: Per-request log record, updated in place
+        owned: True when the body was parsed by the handler rather than
+            passed in by the caller
+        
+    Returns:
+        tuple: (prompt_text, mode, mask_base64, image_base64, mask_size,
+            image_size, error_response) - error_response is None on success,
+            otherwise the other fields are None
+    """
     try:
-        print(f"Body keys: {list(body.keys())}")
+        trace['body_keys'] = list(body.keys())
         
         # Validate prompt structure
         if 'prompt' not in body:
-            return {
-                'statusCode': 400,
-                'headers': get_cors_headers(),
-                'body': json.dumps({'error': 'Missing "prompt" field', 'received_keys': list(body.keys())})
-            }
-        
-        prompt_content = body['prompt']['text']
-        painting_mode = body['prompt']['mode']
+            trace['error'] = 'Missing "prompt" field'
+            return (*_NO_FIELDS, _err(400, 'Missing "prompt" field', received_keys=list(body.keys())))
+        prompt = body['prompt']
+        prompt_content = prompt['text']
+        painting_mode = prompt['mode']
         
-        # Validate mask
+        # Validate mask and base_image
         if 'mask' not in body:
-            return {
-                'statusCode': 400,
-                'headers': get_cors_headers(),
-                'body': json.dumps({'error': 'Missing "mask" field'})
-            }
-        mask_base64 = body['mask'].split(",")[1] if "," in body['mask'] else body['mask']
-        
-        # Validate base_image
+            trace['error'] = 'Missing "mask" field'
+            return (*_NO_FIELDS, _err(400, 'Missing "mask" field'))
         if 'base_image' not in body:
-            return {
-                'statusCode': 400,
-                'headers': get_cors_headers(),
-                'body': json.dumps({'error': 'Missing "base_image" field'})
-            }
-        image_base64 = body['base_image'].split(",")[1] if "," in body['base_image'] else body['base_image']
+            trace['error'] = 'Missing "base_image" field'
+            return (*_NO_FIELDS, _err(400, 'Missing "base_image" field'))
         
+        # A body parsed from the request string belongs to the handler, so its
+        # copies of the images are popped and freed once stripped; a dict body
+        # belongs to the caller and is left untouched
+        take = body.pop if owned else body.__getitem__
+        mask_base64 = _strip_data_uri(take('mask'))
+        image_base64 = _strip_data_uri(take('base_image'))
+        
+        # Strict decoding rejects malformed input and gives the exact byte
+        # sizes; Titan takes the base64 text itself, so it is passed on as is
+        mask_size = len(pybase64.b64decode(mask_base64, validate=True))
+        image_size = len(pybase64.b64decode(image_base64, validate=True))
+        return prompt_content, painting_mode, mask_base64, image_base64, mask_size, image_size, None
     except KeyError as e:
-        print(f"ERROR: Missing key: {str(e)}")
-        return {
-            'statusCode': 400,
-            'headers': get_cors_headers(),
-            'body': json.dumps({'error': f'Missing required field: {str(e)}', 'body_structure': str(body.keys())})
-        }
-    except IndexError as e:
-        print(f"ERROR: Index error (likely malformed base64): {str(e)}")
-        return {
-            'statusCode': 400,
-            'headers': get_cors_headers(),
-            'body': json.dumps({'error': 'Malformed base64 image data'})
-        }
+        trace['error'] = f'Missing key: {str(e)}'
+        return (*_NO_FIELDS, _err(400, f'Missing required field: {str(e)}', body_structure=str(body.keys())))
+    except (IndexError, binascii.Error) as e:
+        trace['error'] = f'Malformed base64 image data: {str(e)}'
+        return (*_NO_FIELDS, _err(400, 'Malformed base64 image data'))
     except Exception as e:
-        print(f"ERROR: Unexpected error extracting parameters: {str(e)}")
-        return {
-            'statusCode': 400,
-            'headers': get_cors_headers(),
-            'body': json.dumps({'error': f'Error extracting parameters: {str(e)}'})
-        }
+        trace['error'] = f'Unexpected error extracting parameters: {str(e)}'
+        return (*_NO_FIELDS, _err(400, f'Error extracting parameters: {str(e)}'))
+
+
+def _safe_log(trace, **record):
+    """
+    Write a request log record to DynamoDB without letting a failure
+    affect the response
+    
+    The write stays synchronous: Lambda freezes the environment as soon as
+    the handler returns, so a deferred write would not run until the next
+    invocation.
+    
+    Args:
+        trace: Per-request log record; a failed write is noted under "log_error"
+        **record: Keyword arguments for log_to_dynamodb
+    """
+    try:
+        log_to_dynamodb(**record)
+    except Exception as e:
+        trace['log_error'] = str(e)
+
+
+def lambda_handler(event, context):
+    """
+    Main Lambda handler for image editing requests
+    
+    Emits a single structured JSON log line per invocation, whatever the
+    outcome, instead of printing as each stage runs.
+    
+    Args:
+        event: API Gateway event with request body
+        context: Lambda context object
+        
+    Returns:
+        dict: Response with status code, headers, and body
+    """
+    trace = {}
+    try:
+        response = _process_request(event, trace)
+        trace['status'] = response['statusCode']
+        return response
+    except Exception as e:
+        trace['error'] = f'Unhandled {type(e).__name__}: {str(e)}'
+        raise
+    finally:
+        sys.stdout.write(orjson.dumps(trace, default=str).decode() + "\n")
+
+
+def _process_request(event, trace):
+    """
+    Validate the request, invoke the Titan model and build the response
+    
+    Args:
+        event: API Gateway event with request body
+        trace: Per-request log record, updated in place
+        
+    Returns:
+        dict: Response with status code, headers, and body
+    """
+    # Generate unique request ID for tracking
+    request_id = str(uuid.uuid4())
+    start_ns = time.monotonic_ns()
+    trace['request_id'] = request_id
+    trace['stage'] = 'received'
+    
+    # Debug: Record the shape of the incoming event (never the base64 payload)
+    if _DEBUG:
+        trace['event_keys'] = list(event.keys())
+        raw = event.get('body')
+        trace['body_len'] = len(raw) if isinstance(raw, str) else None
+    
+    body, err = _parse_body(event, trace)
+    if err:
+        return err
+    trace['stage'] = 'parsed_body'
+    
+    prompt_content, painting_mode, mask_base64, image_base64, mask_size, image_size, err = _extract_fields(
+        body, trace, owned=isinstance(event['body'], str)
+    )
+    if err:
+        return err
+    trace['stage'] = 'extracted_fields'
     
     # Get optional model parameter (defaults to titan)
     model = body.get('model', 'titan').lower()
     canvas_config = body.get('canvas_config', {})
     
-    # Calculate input image sizes
-    image_size = calculate_base64_size(body['base_image'])
-    mask_size = calculate_base64_size(body['mask'])
-    
     # Validate model parameter
-    if model not in ['titan']:
-        error_msg = f'Unsupported model: {model}. Supported models: titan'
+    if model not in _SUPPORTED_MODELS:
+        error_msg = f'Unsupported model: {model}. Supported models: {", ".join(sorted(_SUPPORTED_MODELS))}'
+        trace['error'] = error_msg
         # Log failed request
-        log_to_dynamodb(
+        _safe_log(
+            trace,
             request_id=request_id,
             model_id='unknown',
             prompt=prompt_content,
@@ -155,24 +280,22 @@ def lambda_handler(event, context):
             image_size=image_size,
             mask_size=mask_size,
             output_size=0,
-            generation_time_ms=int((time.time() - start_time) * 1000),
+            generation_time_ms=(time.monotonic_ns() - start_ns) // 1_000_000,
             success=False,
             error_message=error_msg
         )
-        return {
-            'statusCode': 400,
-            'headers': get_cors_headers(),
-            'body': json.dumps({'error': error_msg})
-        }
+        return _err(400, error_msg)
     
     # Prepare request body for Titan model
     try:
         request_body = prepare_titan_request(prompt_content, painting_mode, mask_base64, image_base64)
-        model_id = "amazon.titan-image-generator-v2:0"
+        model_id = _MODEL_ID
     except Exception as e:
         error_msg = f'Error preparing request for {model}: {str(e)}'
+        trace['error'] = error_msg
         # Log failed request
-        log_to_dynamodb(
+        _safe_log(
+            trace,
             request_id=request_id,
             model_id=model_id if 'model_id' in locals() else 'unknown',
             prompt=prompt_content,
@@ -180,41 +303,49 @@ def lambda_handler(event, context):
             image_size=image_size,
             mask_size=mask_size,
             output_size=0,
-            generation_time_ms=int((time.time() - start_time) * 1000),
+            generation_time_ms=(time.monotonic_ns() - start_ns) // 1_000_000,
             success=False,
             error_message=error_msg
         )
-        return {
-            'statusCode': 400,
-            'headers': get_cors_headers(),
-            'body': json.dumps({'error': error_msg})
-        }
+        return _err(400, error_msg)
+    trace['stage'] = 'prepared_request'
     
     # Send the data to the Bedrock client
     try:
         # Record time before Bedrock call
-        bedrock_start_time = time.time()
-        session = boto3.Session()
-        bedrock = session.client(service_name='bedrock-runtime')
-        response_bedrock = bedrock.invoke_model(
+        bedrock_start_ns = time.monotonic_ns()
+        response_bedrock = _BEDROCK.invoke_model(
             body=request_body,
             modelId=model_id,
-            contentType="application/json",
-            accept="application/json"
+            contentType=_CT,
+            accept=_CT
         )
         
         # Calculate generation time
-        generation_time_ms = int((time.time() - bedrock_start_time) * 1000)
+        generation_time_ms = (time.monotonic_ns() - bedrock_start_ns) // 1_000_000
+        trace['stage'] = 'invoked_model'
+        trace['generation_time_ms'] = generation_time_ms
         
         # Get the output from the response
-        response_output = json.loads(response_bedrock.get('body').read())
+        raw_output = response_bedrock['body'].read()
+        response_output = orjson.loads(raw_output)
         images = response_output.get('images')
         
         # Calculate output images size
         output_size = calculate_output_images_size(images)
         
+        # Serialize the response before recording success, so a failure here
+        # is logged only once, as a failed request
+        resp_body = orjson.dumps({
+            'images': images,
+            'model_used': model,
+            'request_id': request_id,
+            'generation_time_ms': generation_time_ms
+        }).decode()
+        
         # Log successful request to DynamoDB
-        log_to_dynamodb(
+        _safe_log(
+            trace,
             request_id=request_id,
             model_id=model_id,
             prompt=prompt_content,
@@ -229,21 +360,18 @@ def lambda_handler(event, context):
         # Return the response with CORS headers
         return {
             'statusCode': 200,
-            'headers': get_cors_headers(),
-            'body': json.dumps({
-                'images': images,
-                'model_used': model,
-                'request_id': request_id,
-                'generation_time_ms': generation_time_ms
-            })
+            'headers': dict(_CORS_HEADERS),
+            'body': resp_body
         }
         
     except Exception as e:
         error_message = str(e)
-        generation_time_ms = int((time.time() - start_time) * 1000)
+        trace['error'] = error_message
+        generation_time_ms = (time.monotonic_ns() - start_ns) // 1_000_000
         
         # Log failed request to DynamoDB
-        log_to_dynamodb(
+        _safe_log(
+            trace,
             request_id=request_id,
             model_id=model_id,
             prompt=prompt_content,
@@ -257,12 +385,4 @@ def lambda_handler(event, context):
         )
         
         # Return an error response
-        return {
-            'statusCode': 500,
-            'headers': get_cors_headers(),
-            'body': json.dumps({
-                'error': error_message,
-                'model_attempted': model,
-                'request_id': request_id
-            })
-        }
+        return _err(500, error_message, model_attempted=model, request_id=request_id)